@@ -2,7 +2,16 @@ from . import server
 
 
 def main():
-    server.run("ebiodiv.app:app")
+    if server.ARGS.command == "snapshot":
+        from . import datasource
+        server.configure_logging()
+        datasource.run_snapshot(server.CONFIG["datasource"], server.ARGS)
+    elif server.ARGS.command == "score":
+        from . import batchscoring
+        server.configure_logging()
+        batchscoring.run_score(server.CONFIG["datasource"], server.ARGS)
+    else:
+        server.run("ebiodiv.app:app")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+"""
+Admission control for the memory hungry requests.
+
+A scored request holds at once the raw upstream body, the decoded JSON tree,
+the normalized copies of the occurrences and the re-encoded output.
+Each worker admits these requests according to:
+* a memory budget: the sum of the estimated costs of the running requests
+  and of the cached occurrence sets (see set_cached_memory),
+* a concurrency budget: the number of running requests.
+
+Requests that do not fit wait in a bounded FIFO queue, and are rejected when the queue
+is full or when they have waited too long.
+"""
+import asyncio
+from collections import deque
+from typing import Dict, Optional
+
+
+__all__ = ['AdmissionRejected', 'AdmissionController', 'Ticket']
+
+
+MB = 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    """The request can't be admitted: the client should retry after ``retry_after`` seconds"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Reservation of ``cost`` bytes by an admitted request"""
+
+    def __init__(self, controller: "AdmissionController", cost: int):
+        self._controller = controller
+        self.cost = cost
+
+    async def resize(self, cost: int) -> None:
+        """Update the estimated cost once more is known about the request (i.e. the content-length or the relation count).
+
+        The request is already running: the new cost is accounted even if it exceeds the budget.
+        """
+        await self._controller.resize(self, cost)
+
+
+class AdmissionController:
+
+    def __init__(self, memory_budget: int, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.memory_budget = memory_budget
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.memory_in_use = 0
+        # estimated memory of the cached occurrence sets, included in memory_in_use
+        self.cached_memory = 0
+        self.running = 0
+        # one token per waiting request, in arrival order
+        self._waiters = deque()
+        # created on first use, to be bound to the event loop of the worker
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def queue_length(self) -> int:
+        return len(self._waiters)
+
+    @classmethod
+    def from_config(cls, config) -> "AdmissionController":
+        return cls(
+            memory_budget=int(config["memory_budget"]) * MB,
+            max_concurrent=int(config["max_concurrent"]),
+            max_queue=int(config["max_queue"]),
+            queue_timeout=float(config["queue_timeout"]),
+            retry_after=int(config["retry_after"]),
+        )
+
+    def _fits(self, cost: int) -> bool:
+        if self.running >= self.max_concurrent:
+            return False
+        # a request larger than the whole budget is admitted when nothing else is running
+        return self.running == 0 or self.memory_in_use + cost <= self.memory_budget
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, cost: int) -> Ticket:
+        condition = self._get_condition()
+        async with condition:
+            # FIFO: a request doesn't overtake the waiting ones
+            if self._waiters or not self._fits(cost):
+                if self.queue_length >= self.max_queue:
+                    raise AdmissionRejected(self.retry_after)
+                token = object()
+                self._waiters.append(token)
+                try:
+                    await asyncio.wait_for(
+                        condition.wait_for(lambda: self._waiters[0] is token and self._fits(cost)),
+                        self.queue_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    raise AdmissionRejected(self.retry_after)
+                finally:
+                    self._waiters.remove(token)
+                    # the next waiter may be the first one now
+                    condition.notify_all()
+            self.running += 1
+            self.memory_in_use += cost
+            return Ticket(self, cost)
+
+    async def resize(self, ticket: Ticket, cost: int) -> None:
+        async with self._get_condition():
+            self.memory_in_use += cost - ticket.cost
+            ticket.cost = cost
+            self._condition.notify_all()
+
+    async def set_cached_memory(self, cached_memory: int) -> None:
+        """Account the estimated memory of the cached occurrence sets"""
+        async with self._get_condition():
+            self.memory_in_use += cached_memory - self.cached_memory
+            self.cached_memory = cached_memory
+            self._condition.notify_all()
+
+    async def release(self, ticket: Ticket) -> None:
+        async with self._get_condition():
+            self.running -= 1
+            self.memory_in_use -= ticket.cost
+            self._condition.notify_all()
+
+    def gauges(self) -> Dict[str, int]:
+        return {
+            "running": self.running,
+            "queue_length": self.queue_length,
+            "memory_in_use": self.memory_in_use,
+            "cached_memory": self.cached_memory,
+            "memory_budget": self.memory_budget,
+            "max_concurrent": self.max_concurrent,
+        }
@@ -1,26 +1,40 @@
 import asyncio
 import logging
+import math
 from itertools import chain, islice
+from enum import Enum
 from logging import Logger
 from time import time
 from typing import Dict, List, Optional, Union
 
-import aiohttp
+import numpy as np
 import orjson
-from fastapi import Body, FastAPI, APIRouter, Query, Request, Response
+from fastapi import Body, FastAPI, APIRouter, Header, Query, Request, Response
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from starlette.middleware.cors import CORSMiddleware
 
-from . import matchingalgorithm, server, utils
+from . import admission, datasource, decisions, encoders, matchingalgorithm, scheduling, server, utils
+from .occurrenceset import OccurrenceSet, OccurrenceSetCache, PreviousScores, normalize_occurrences
 
 logger = logging.getLogger(__name__)
 
 CONFIG = server.CONFIG
-HTTP_SESSION: aiohttp.ClientSession = None
 DATASOURCE = CONFIG["datasource"]
+DATA_SOURCE = datasource.from_config(DATASOURCE)
+ADMISSION_CONFIG = CONFIG["admission"]
+ADMISSION = admission.AdmissionController.from_config(ADMISSION_CONFIG)
+OCCURRENCE_SETS = OccurrenceSetCache.from_config(CONFIG["occurrences"])
+DECISIONS_CONFIG = CONFIG["decisions"]
+DECISION_QUEUE: Optional[decisions.DecisionQueue] = None
+METADATA_CONFIG = CONFIG["metadata"]
+METADATA_CACHE: Dict[str, "CachedResponse"] = {}
+METADATA_REFRESH_TASKS: Dict[str, asyncio.Task] = {}
+SCORING_CONFIG = CONFIG["scoring"]
+COOPERATIVE_SCORING = SCORING_CONFIG["mode"] == "cooperative"
+LAG_MONITOR = scheduling.EventLoopLagMonitor(float(SCORING_CONFIG["lag_interval"]), int(SCORING_CONFIG["lag_window"]))
 
 app = FastAPI(
     title="eBioDiv - Backend API",
@@ -74,34 +88,39 @@ app.add_middleware(
 
 server.configure_app(app)
 
-async def on_request_end(session, trace_config_ctx, params):
-    logger.info(f"\"{params.method} {params.url}\" {params.response.status} {params.response.headers.get('content-length', '')}")
+@app.on_event("startup")
+async def startup_event():
+    await DATA_SOURCE.start()
 
 
 @app.on_event("startup")
-async def startup_event():
-    """create HTTP client & log outgoing HTTP request"""
-    global HTTP_SESSION
-    trace_config = aiohttp.TraceConfig()
-    trace_config.on_request_end.append(on_request_end)
-    timeout = aiohttp.ClientTimeout(float(DATASOURCE["timeout"]))
-    HTTP_SESSION = aiohttp.ClientSession(trace_configs=[trace_config], timeout=timeout, headers={
-        'User-Agent': 'ebiodiv-backend'
-    })
+async def start_lag_monitor():
+    LAG_MONITOR.start()
+
+
+@app.on_event("startup")
+async def start_decision_queue():
+    global DECISION_QUEUE
+    if DECISIONS_CONFIG.getboolean("write_behind"):
+        DECISION_QUEUE = decisions.DecisionQueue.from_config(DECISIONS_CONFIG, _send_decisions)
+        await DECISION_QUEUE.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await HTTP_SESSION.close()
+    if DECISION_QUEUE is not None:
+        await DECISION_QUEUE.stop(float(DECISIONS_CONFIG["shutdown_timeout"]))
+    await LAG_MONITOR.stop()
+    await DATA_SOURCE.close()
 
 
 class Fields(BaseModel):
     __root__: Dict[str, List[str]]
 
 
-async def proxy_response(url, method='get', **kwargs):
+async def proxy_response(endpoint, method='get', **kwargs):
     with utils.measure_time() as now:
-        async with getattr(HTTP_SESSION, method)(url, **kwargs) as response:
+        async with DATA_SOURCE.request(method, endpoint, **kwargs) as response:
             content = await response.read()
             http_time = now()
             return Response(
@@ -121,39 +140,360 @@ async def get_fields():
     return result
 
 
+@api_router.get("/status", description="Gauges of the worker which answers", tags=["meta"])
+async def get_status():
+    result = {
+        "admission": ADMISSION.gauges(),
+        "eventLoop": LAG_MONITOR.gauges(),
+    }
+    if DECISION_QUEUE is not None:
+        result["decisions"] = DECISION_QUEUE.gauges()
+    return result
+
+
+class CachedResponse:
+    """Upstream response of a metadata endpoint"""
+
+    def __init__(self, content: bytes, status: int, media_type: str):
+        self.content = content
+        self.status = status
+        self.media_type = media_type
+        self.fetched = time()
+        self._data = None
+
+    @property
+    def age(self) -> float:
+        return time() - self.fetched
+
+    @property
+    def data(self):
+        """Decoded JSON content"""
+        if self._data is None:
+            self._data = orjson.loads(self.content)
+        return self._data
+
+    def to_response(self) -> Response:
+        return Response(
+            self.content,
+            status_code=self.status,
+            media_type=self.media_type,
+            headers={'age': str(int(self.age))},
+        )
+
+
+async def _fetch_metadata(name: str) -> CachedResponse:
+    async with DATA_SOURCE.request("get", name) as response:
+        content = await response.read()
+        cached_response = CachedResponse(content, response.status, response.headers["Content-Type"])
+    if cached_response.status == 200:
+        METADATA_CACHE[name] = cached_response
+    else:
+        logger.warning("%s: upstream status %i", name, cached_response.status)
+    return cached_response
+
+
+def _on_metadata_refreshed(name: str, task: asyncio.Task) -> None:
+    del METADATA_REFRESH_TASKS[name]
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("%s: refresh failed: %r", name, task.exception())
+
+
+def _refresh_metadata(name: str) -> asyncio.Task:
+    """Fetch the metadata in a background task, one task per endpoint"""
+    task = METADATA_REFRESH_TASKS.get(name)
+    if task is None:
+        task = asyncio.create_task(_fetch_metadata(name))
+        task.add_done_callback(lambda task: _on_metadata_refreshed(name, task))
+        METADATA_REFRESH_TASKS[name] = task
+    return task
+
+
+async def _get_metadata(name: str) -> CachedResponse:
+    """Stale-while-revalidate cache of the metadata endpoints.
+
+    * fresh entry: served
+    * stale entry: served, and refreshed in the background
+    * expired entry: refreshed, but served if the upstream fails or doesn't answer in time
+    * no entry: wait for the upstream response
+    """
+    cached_response = METADATA_CACHE.get(name)
+    if cached_response is not None:
+        age = cached_response.age
+        if age < float(METADATA_CONFIG["fresh"]):
+            return cached_response
+        if age < float(METADATA_CONFIG["fresh"]) + float(METADATA_CONFIG["stale"]):
+            _refresh_metadata(name)
+            return cached_response
+
+    # asyncio.shield: the refresh continues in background after a timeout
+    refresh = asyncio.shield(_refresh_metadata(name))
+    if cached_response is None:
+        return await refresh
+    try:
+        refreshed_response = await asyncio.wait_for(refresh, float(METADATA_CONFIG["timeout"]))
+    except Exception:
+        # any upstream failure, including an invalid response: serve the expired entry
+        logger.warning("%s: serve the expired entry", name, exc_info=True)
+        return cached_response
+    return refreshed_response if refreshed_response.status == 200 else cached_response
+
+
 @api_router.get("/institutionList", description="basic list of institutions, including datasets", tags=["data"])
 async def get_institutionList():
-    return await proxy_response(DATASOURCE["url"] + "institutionList")
+    return (await _get_metadata("institutionList")).to_response()
 
 
 @api_router.get("/institutions", description="list of full institution record", tags=["data"])
 async def get_institutions():
-    return await proxy_response(DATASOURCE["url"] + "institutions")
+    return (await _get_metadata("institutions")).to_response()
 
 
 @api_router.get("/datasets", description="list of datasets", tags=["data"])
 async def get_datasets(institutionKey: Optional[str] = None):
-    params = {}
-    if institutionKey:
-        params["institutionKey"] = institutionKey
-    return await proxy_response(DATASOURCE["url"] + "datasets", params=params)
+    cached_response = await _get_metadata("datasets")
+    if not institutionKey:
+        return cached_response.to_response()
+    if (
+        cached_response.status == 200
+        and isinstance(cached_response.data, list)
+        and any(isinstance(dataset, dict) and "institutionKey" in dataset for dataset in cached_response.data)
+    ):
+        # filter the cached list of all datasets
+        return ORJSONResponse(
+            [dataset for dataset in cached_response.data if str(dataset.get("institutionKey")) == institutionKey],
+            headers={'age': str(int(cached_response.age))},
+        )
+    # the records don't have institutionKey: let the upstream filter
+    return await proxy_response("datasets", params={"institutionKey": institutionKey})
+
+
+class RelationSort(str, Enum):
+    global_ascending = "$global"
+    global_descending = "-$global"
+
+
+def _get_content_length(headers) -> int:
+    content_length = headers.get("content-length")
+    if content_length:
+        return int(content_length)
+    return int(ADMISSION_CONFIG["default_content_length"]) * admission.MB
+
+
+def _estimate_cost(content_length: int, relation_count: int = 0) -> int:
+    """Estimated memory used by a request which decodes the occurrences, in bytes"""
+    return (
+        content_length * int(ADMISSION_CONFIG["body_factor"])
+        + relation_count * int(ADMISSION_CONFIG["relation_cost"])
+    )
 
 
-def _add_score(data) -> None:
-    # normalized a copy of the occurrences
+def _get_window_cost(occurrence_set: OccurrenceSet, window_length: int) -> int:
+    """Estimated memory used by a window of a cached OccurrenceSet, in bytes"""
+    # the occurrences are already decoded: only the window is accounted
+    window_content_length = occurrence_set.content_length * window_length // max(1, len(occurrence_set))
+    return _estimate_cost(window_content_length, window_length)
+
+
+def _too_many_requests(exc: admission.AdmissionRejected):
+    return ORJSONResponse(
+        status_code=429,
+        content={"error": "Too many concurrent scored requests"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def _deadline_exceeded():
+    # the occurrence set is cached before the scoring starts:
+    # the next request continues from the scores computed so far
+    return ORJSONResponse(
+        status_code=503,
+        content={"error": "Scoring deadline exceeded"},
+        headers={"Retry-After": SCORING_CONFIG["retry_after"]},
+    )
+
+
+def _get_deadline() -> float:
+    """Deadline of the scoring, once the occurrences are decoded and normalized"""
+    return asyncio.get_event_loop().time() + float(SCORING_CONFIG["deadline"])
+
+
+async def _new_occurrence_set(
+    data, content_length: int, previous: Optional[Union[OccurrenceSet, PreviousScores]]
+) -> OccurrenceSet:
+    """Normalize the occurrences in the executor, or on the event loop in slices (cooperative mode).
+
+    The normalization has no deadline: the occurrence set is cached, even if the scoring is not finished at the deadline.
+    """
+    if not COOPERATIVE_SCORING:
+        return await asyncio.get_event_loop().run_in_executor(None, OccurrenceSet, data, content_length, previous)
+    slice_budget = float(SCORING_CONFIG["slice_budget"])
     normalized_occ_dict = {}
-    for occ_key, occ in data["occurrences"].items():
-        normalized_occ = occ.copy()
-        matchingalgorithm.normalize_occurrence(normalized_occ)
-        normalized_occ_dict[int(occ_key)] = normalized_occ
+    await scheduling.run_in_slices(
+        lambda items: normalized_occ_dict.update(normalize_occurrences(items)),
+        list(data["occurrences"].items()),
+        slice_budget,
+        math.inf,
+    )
+    occurrence_set = OccurrenceSet(data, content_length, None, normalized_occ_dict)
+    if previous is not None:
+        unchanged_occ_keys = set()
+        await scheduling.run_in_slices(
+            lambda occ_keys: unchanged_occ_keys.update(occurrence_set.get_unchanged_occ_keys(previous, occ_keys)),
+            list(normalized_occ_dict),
+            slice_budget,
+            math.inf,
+        )
+        await scheduling.run_in_slices(
+            lambda indices: occurrence_set.copy_scores(previous, unchanged_occ_keys, indices),
+            range(len(occurrence_set)),
+            slice_budget,
+            math.inf,
+        )
+    return occurrence_set
+
+
+async def _call_scoring(occurrence_set: OccurrenceSet, indices: np.ndarray, deadline: float, function, *args):
+    """Return function(*args) which scores the relations at indices.
+
+    Either call the function in the executor,
+    or in cooperative mode score the relations on the event loop in slices, then call the function.
+    """
+    if not COOPERATIVE_SCORING:
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+    await scheduling.run_in_slices(
+        occurrence_set.score,
+        occurrence_set.get_missing(indices),
+        float(SCORING_CONFIG["slice_budget"]),
+        deadline,
+    )
+    return function(*args)
+
+
+def _get_window_indices(occurrence_set: OccurrenceSet, offset: int, limit: Optional[int], sort: Optional[RelationSort]) -> np.ndarray:
+    if sort is None:
+        indices = np.arange(len(occurrence_set))
+    else:
+        indices = occurrence_set.get_sorted_indices(sort is RelationSort.global_descending)
+    return indices[offset:None if limit is None else offset + limit]
+
+
+def _get_window(occurrence_set: OccurrenceSet, offset: int, limit: Optional[int], sort: Optional[RelationSort], scores: bool, score_dicts: bool):
+    """Select the relations, score them if required.
+
+    Return the score matrix of the window (None without scores) and the window.
+    score_dicts: add the "scores" dictionary to each relation (for JSON)
+    """
+    indices = _get_window_indices(occurrence_set, offset, limit, sort)
+    if not scores:
+        return None, occurrence_set.get_window(indices)
+    score_matrix = occurrence_set.get_score_matrix(indices)
+    return score_matrix, occurrence_set.get_window(indices, score_dicts)
 
-    # get the scores from the normalized occurrences
-    # leave the original occurrences untouched
-    for relation in data["occurrenceRelations"]:
-        o1 = normalized_occ_dict[relation["occurrenceKey1"]]
-        o2 = normalized_occ_dict[relation["occurrenceKey2"]]
-        relation["scores"] = matchingalgorithm.get_scores(o1, o2)
-    return data
+
+async def _get_window_in_slices(
+    occurrence_set: OccurrenceSet, indices_to_score: np.ndarray, deadline: float,
+    offset: int, limit: Optional[int], sort: Optional[RelationSort], scores: bool, score_dicts: bool,
+):
+    """Same as _get_window, on the event loop in slices (cooperative mode)"""
+    slice_budget = float(SCORING_CONFIG["slice_budget"])
+    await scheduling.run_in_slices(occurrence_set.score, occurrence_set.get_missing(indices_to_score), slice_budget, deadline)
+    indices = _get_window_indices(occurrence_set, offset, limit, sort)
+    score_matrix = occurrence_set.score_matrix[indices] if scores else None
+    relations = []
+    await scheduling.run_in_slices(
+        lambda part: relations.extend(occurrence_set.get_relations(part, scores and score_dicts)),
+        indices,
+        slice_budget,
+        math.inf,
+    )
+    if len(relations) == len(occurrence_set):
+        occurrences = occurrence_set.data["occurrences"]
+    else:
+        occurrences = {}
+        await scheduling.run_in_slices(
+            lambda part: occurrences.update(occurrence_set.get_occurrences(part)),
+            relations,
+            slice_budget,
+            math.inf,
+        )
+    return score_matrix, {
+        "occurrences": occurrences,
+        "occurrenceRelations": relations,
+        **occurrence_set.get_other_items(occurrences),
+    }
+
+
+async def _load_occurrence_set(params, cache_key, timings) -> Union[Response, OccurrenceSet]:
+    """Fetch, decode and normalize the occurrences, then cache them.
+
+    Return the upstream response if it is an error.
+    Raise AdmissionRejected if the worker can't handle the upstream response now.
+    """
+    # admitted before the upstream request: a queued request doesn't hold an upstream connection.
+    # the cost is estimated from the previous response, then from the content-length header
+    previous = OCCURRENCE_SETS.get_previous(cache_key)
+    if previous is not None:
+        content_length = previous.content_length
+    else:
+        content_length = int(ADMISSION_CONFIG["default_content_length"]) * admission.MB
+    ticket = await ADMISSION.acquire(_estimate_cost(content_length))
+    try:
+        with utils.measure_time() as now:
+            async with DATA_SOURCE.request("get", "occurrences", params=params) as response:
+                if response.status != 200:
+                    # error: proxy the response
+                    content = await response.read()
+                    http_time = now()
+                    return Response(
+                        content,
+                        status_code=response.status,
+                        media_type=response.headers["Content-Type"],
+                        headers = {
+                            'server-timing': 'http;dur=' + str(round(http_time * 1000))
+                        }
+                    )
+
+                content_length = _get_content_length(response.headers)
+                await ticket.resize(_estimate_cost(content_length))
+                content = await response.read()
+        timings['http'] = now()
+
+        with utils.measure_time() as now:
+            # orjson.loads(content) takes a few seconds on a large documents (>10MB).
+            data = orjson.loads(content)
+            del content
+            await ticket.resize(_estimate_cost(content_length, len(data["occurrenceRelations"])))
+        timings['json_loads'] = now()
+
+        # copy the scores of the unchanged relations from the previous (expired) occurrence set
+        with utils.measure_time() as now:
+            occurrence_set = await _new_occurrence_set(data, content_length, OCCURRENCE_SETS.get_previous(cache_key))
+            if DECISION_QUEUE is not None:
+                # the upstream doesn't have the queued decisions yet: serve the decisions acknowledged by this worker
+                occurrence_set.update_decisions(DECISION_QUEUE.pending.values())
+            OCCURRENCE_SETS.put(cache_key, occurrence_set, _estimate_cost(content_length, len(occurrence_set)))
+            await ADMISSION.set_cached_memory(OCCURRENCE_SETS.memory)
+        timings['normalize'] = now()
+    finally:
+        await ADMISSION.release(ticket)
+    return occurrence_set
+
+
+async def _get_cached_occurrence_set(cache_key) -> Optional[OccurrenceSet]:
+    occurrence_set = OCCURRENCE_SETS.get(cache_key)
+    # the expired entries may have been removed
+    await ADMISSION.set_cached_memory(OCCURRENCE_SETS.memory)
+    return occurrence_set
+
+
+def _get_server_timing(timings: Dict[str, float]) -> str:
+    # output server-timing HTTP header
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+    # https://twitter.com/firefoxdevtools/status/1201914691863244800
+    return ', '.join(
+        name + ';dur=' + str(round(value * 1000, 3))
+        for name, value in timings.items()
+    )
 
 
 @api_router.get("/occurrences", description="list of occurrences", tags=["data"])
@@ -162,7 +502,11 @@ async def get_occurrences(
     datasetKey: Optional[str] = None,
     occurrenceKeys: Optional[str] = None,
     fetchMissing: Optional[bool] = Query(default=None, description="Fetch missing occurrences, allow to add new occurrences"),
-    scores: bool = False
+    scores: bool = False,
+    offset: int = Query(default=0, ge=0, description="Index of the first relation to return"),
+    limit: Optional[int] = Query(default=None, ge=1, description="Maximum number of relations to return"),
+    sort: Optional[RelationSort] = Query(default=None, description="Sort the relations by global score: $global (ascending) or -$global (descending)"),
+    accept: Optional[str] = Header(default=None, description="With scores=true: " + ", ".join(encoders.get_available_media_types())),
 ):
     params = {}
     if institutionKey is not None:
@@ -171,66 +515,184 @@ async def get_occurrences(
         params["datasetKey"] = datasetKey
     if occurrenceKeys is not None:
         params["occurrenceKeys"] = occurrenceKeys
+    # the response with fetchMissing=true is cached under the same key than without
+    cache_key = tuple(sorted(params.items()))
     if fetchMissing is not None:
         params["fetchMissing"] = "true" if fetchMissing else "false"
 
-    timings = {}
-
-    with utils.measure_time() as now:
-        async with HTTP_SESSION.get(DATASOURCE["url"] + "occurrences", params=params) as response:
-            if response.status != 200 or not scores:
-                # error: proxy the response
-                content = await response.read()
-                http_time = now()
-                return Response(
-                    content,
-                    status_code=response.status,
-                    media_type=response.headers["Content-Type"],
-                    headers = {
-                        'server-timing': 'http;dur=' + str(round(http_time * 1000))
-                    }
-                )
-
-            content = await response.read()
-    timings['http'] = now()
-
-    with utils.measure_time() as now:
-        # orjson.loads(content) takes a few seconds on a large documents (>10MB).
-        data = orjson.loads(content)
-    timings['json_loads'] = now()
+    paginated = offset > 0 or limit is not None or sort is not None
+    if not scores and not paginated:
+        return await proxy_response("occurrences", params=params)
 
-    # add scores
-    with utils.measure_time() as now:
-        if scores:
-            await asyncio.get_event_loop().run_in_executor(None, _add_score, data)
-    timings['scoring'] = now()
+    # the binary encodings read the score matrix: the "scores" dictionaries are only for JSON
+    media_type = encoders.negotiate(accept) if scores else encoders.MEDIA_TYPE_JSON
+    timings = {}
 
-    # serialize JSON
-    with utils.measure_time() as now:
-        content = orjson.dumps(data)
-    timings['json_dumps'] = now()
+    try:
+        # only the windows are read from the cache: the decisions posted to the other workers
+        # are not in the cache of this worker, the full list is always fetched again
+        occurrence_set = None if fetchMissing or not paginated else await _get_cached_occurrence_set(cache_key)
+        if occurrence_set is None:
+            occurrence_set = await _load_occurrence_set(params, cache_key, timings)
+            if isinstance(occurrence_set, Response):
+                return occurrence_set
+
+        window_length = max(0, min(len(occurrence_set) - offset, limit or len(occurrence_set)))
+        ticket = await ADMISSION.acquire(_get_window_cost(occurrence_set, window_length))
+    except admission.AdmissionRejected as exc:
+        return _too_many_requests(exc)
+
+    deadline = _get_deadline()
+    # the relations to score: sort requires all the scores
+    if sort is not None:
+        indices_to_score = np.arange(len(occurrence_set))
+    elif scores:
+        indices_to_score = np.arange(len(occurrence_set))[offset:None if limit is None else offset + limit]
+    else:
+        indices_to_score = np.arange(0)
 
-    # output server-timing HTTP header
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
-    # https://twitter.com/firefoxdevtools/status/1201914691863244800
-    timings_values = [
-        name + ';dur=' + str(round(value * 1000, 3))
-        for name, value in timings.items()
-    ]
+    try:
+        # select and score the relations
+        with utils.measure_time() as now:
+            window_args = (offset, limit, sort, scores, media_type == encoders.MEDIA_TYPE_JSON)
+            if COOPERATIVE_SCORING:
+                score_matrix, window = await _get_window_in_slices(occurrence_set, indices_to_score, deadline, *window_args)
+            else:
+                score_matrix, window = await asyncio.get_event_loop().run_in_executor(None, _get_window, occurrence_set, *window_args)
+            if paginated:
+                window.update(total=len(occurrence_set), offset=offset, limit=limit)
+        timings['scoring'] = now()
+
+        # serialize
+        with utils.measure_time() as now:
+            if not COOPERATIVE_SCORING:
+                content = await asyncio.get_event_loop().run_in_executor(None, encoders.encode, media_type, window, score_matrix)
+            elif media_type == encoders.MEDIA_TYPE_JSON:
+                content = await encoders.encode_json_in_slices(window, float(SCORING_CONFIG["slice_budget"]))
+            else:
+                # the binary encodings are not sliced
+                content = encoders.encode(media_type, window, score_matrix)
+            del window, score_matrix
+        timings['encode'] = now()
+    except scheduling.DeadlineExceeded:
+        return _deadline_exceeded()
+    finally:
+        await ADMISSION.release(ticket)
 
     return Response(
-        orjson.dumps(data),
-        status_code=response.status,
-        media_type="application/json",
+        content,
+        status_code=200,
+        media_type=media_type,
         headers = {
-            'server-timing': ', '.join(timings_values)
+            'server-timing': _get_server_timing(timings),
+            'vary': 'Accept',
         }
     )
 
 
+def _parse_min_field_scores(min_field_scores: Optional[str]) -> Dict[str, float]:
+    """Parse "catalogNumber:0.8,recordedBy:0.5", raise ValueError if the value is invalid"""
+    result = {}
+    if not min_field_scores:
+        return result
+    for item in min_field_scores.split(","):
+        label, separator, score = item.partition(":")
+        label = label.strip()
+        if not separator or label not in matchingalgorithm.SCORE_LABELS:
+            raise ValueError(f"invalid field score: {item!r}")
+        result[label] = float(score)
+    return result
+
+
+def _get_top_window(occurrence_set: OccurrenceSet, n: int, min_score: float, min_field_scores: Dict[str, float]):
+    indices, total = occurrence_set.get_top(n, min_score, min_field_scores)
+    window = occurrence_set.get_window(indices, with_scores=True)
+    window["total"] = total
+    return window
+
+
+@api_router.get(
+    "/occurrenceRelations/top",
+    description="Relations with the highest global scores. The relations are scored the first time, then ranked without scoring.",
+    tags=["matching"],
+)
+async def get_top_occurrence_relations(
+    institutionKey: Optional[str] = None,
+    datasetKey: Optional[str] = None,
+    n: int = Query(default=10, ge=1, le=1000, description="Maximum number of relations to return"),
+    minScore: float = Query(default=0, description="Minimum global score"),
+    minFieldScores: Optional[str] = Query(default=None, description="Minimum score per field, for example: catalogNumber:0.8,recordedBy:0.5"),
+):
+    try:
+        min_field_scores = _parse_min_field_scores(minFieldScores)
+    except ValueError as exc:
+        return ORJSONResponse(status_code=400, content={"error": str(exc)})
+
+    params = {}
+    if institutionKey is not None:
+        params["institutionKey"] = institutionKey
+    if datasetKey is not None:
+        params["datasetKey"] = datasetKey
+    cache_key = tuple(sorted(params.items()))
+    timings = {}
+
+    try:
+        occurrence_set = await _get_cached_occurrence_set(cache_key)
+        if occurrence_set is None:
+            occurrence_set = await _load_occurrence_set(params, cache_key, timings)
+            if isinstance(occurrence_set, Response):
+                return occurrence_set
+
+        # the first ranking scores all the relations, like /occurrences?sort=...
+        ranking_length = len(occurrence_set) if occurrence_set.ranking is None else min(n, len(occurrence_set))
+        ticket = await ADMISSION.acquire(_get_window_cost(occurrence_set, ranking_length))
+    except admission.AdmissionRejected as exc:
+        return _too_many_requests(exc)
+
+    deadline = _get_deadline()
+    try:
+        with utils.measure_time() as now:
+            if occurrence_set.ranking is None:
+                window = await _call_scoring(
+                    occurrence_set, np.arange(len(occurrence_set)), deadline,
+                    _get_top_window, occurrence_set, n, minScore, min_field_scores
+                )
+            else:
+                # n is bounded: the window is built on the event loop
+                window = _get_top_window(occurrence_set, n, minScore, min_field_scores)
+        timings['ranking'] = now()
+    except scheduling.DeadlineExceeded:
+        return _deadline_exceeded()
+    finally:
+        await ADMISSION.release(ticket)
+
+    return ORJSONResponse(window, headers={'server-timing': _get_server_timing(timings)})
+
+
+async def _send_decisions(relations: List[dict]) -> int:
+    async with DATA_SOURCE.request("post", "occurrenceRelations", json={"occurrenceRelations": relations}) as response:
+        await response.read()
+        return response.status
+
+
 @api_router.post("/occurrenceRelations", description='Update the "match" value between occurrences', tags=["matching"])
 async def occurrence_relations(data = Body(default=None, example="""{"occurrenceRelations":[{"occurrenceKey1":20,"occurrenceKey2":42,"decision":null},{"occurrenceKey1":20,"occurrenceKey2":42,"decision":true},{"occurrenceKey1":20,"occurrenceKey2":42,"decision":false}]}""")):
-    return await proxy_response(DATASOURCE["url"] + "occurrenceRelations", method='post', json=data)
+    if DECISION_QUEUE is not None:
+        # write-behind: acknowledge locally, the queue sends the decisions to the upstream
+        relations = data.get("occurrenceRelations") if isinstance(data, dict) else None
+        if not isinstance(relations, list) or not all(decisions.is_valid_relation(relation) for relation in relations):
+            return ORJSONResponse(
+                status_code=400,
+                content={"error": "occurrenceRelations: list of {occurrenceKey1: int, occurrenceKey2: int, decision: true, false or null} expected"},
+            )
+        DECISION_QUEUE.put(relations)
+        OCCURRENCE_SETS.update_decisions(relations)
+        return ORJSONResponse(status_code=202, content={"queued": len(relations)})
+
+    response = await proxy_response("occurrenceRelations", method='post', json=data)
+    if 200 <= response.status_code < 300 and isinstance(data, dict):
+        OCCURRENCE_SETS.update_decisions(data.get("occurrenceRelations") or [])
+    return response
 
 
 app.include_router(api_router)
@@ -0,0 +1,147 @@
+"""
+Offline scoring of all the relations of the institutions, without the HTTP server.
+
+The occurrences are read dataset by dataset from the configured data source (HTTP or snapshot),
+and scored in parallel by a pool of processes. Each dataset is written in its own file:
+* npz (numpy.savez_compressed): one array per column,
+* parquet (requires pyarrow): one table.
+
+Columns: occurrenceKey1, occurrenceKey2, decision (1: true, 0: false, -1: null), then one
+"scores.<label>" float32 column per score (np.nan: no score).
+
+A dataset file is written atomically. Each run scores all the datasets again, except with resume:
+the datasets already scored by the interrupted run (listed in RUN_MANIFEST) are skipped.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import orjson
+
+from . import datasource, matchingalgorithm, utils
+from .occurrenceset import OccurrenceSet
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+__all__ = ['score_dataset', 'score_datasets', 'run_score']
+
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("npz", "parquet")
+
+DECISION_VALUES = {True: 1, False: 0, None: -1}
+
+# the files written by the last run, see utils.RunManifest
+RUN_MANIFEST = "run-manifest.txt"
+
+
+def _get_columns(data) -> Dict[str, np.ndarray]:
+    occurrence_set = OccurrenceSet(data)
+    score_matrix = occurrence_set.get_score_matrix(np.arange(len(occurrence_set)))
+    relations = occurrence_set.relations
+    columns = {
+        "occurrenceKey1": np.array([relation["occurrenceKey1"] for relation in relations], dtype=np.int64),
+        "occurrenceKey2": np.array([relation["occurrenceKey2"] for relation in relations], dtype=np.int64),
+        "decision": np.array([DECISION_VALUES.get(relation.get("decision"), -1) for relation in relations], dtype=np.int8),
+    }
+    for label, column in zip(matchingalgorithm.SCORE_LABELS, score_matrix.T):
+        columns["scores." + label] = column.astype(np.float32)
+    return columns
+
+
+def score_dataset(content: bytes, path: str, output_format: str) -> int:
+    """Score the relations of a dataset (run in a worker process), return the number of relations"""
+    columns = _get_columns(orjson.loads(content))
+    tmp_path = path + ".tmp"
+    if output_format == "parquet":
+        pyarrow.parquet.write_table(pyarrow.table(columns), tmp_path)
+    else:
+        # with a file name, np.savez_compressed would add the .npz extension
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **columns)
+    os.replace(tmp_path, path)
+    return len(columns["occurrenceKey1"])
+
+
+async def score_datasets(
+    source: datasource.DataSource,
+    directory: Path,
+    institution_keys: Optional[List[str]],
+    processes: int,
+    output_format: str,
+    resume: bool = False,
+) -> Dict[str, int]:
+    directory.mkdir(parents=True, exist_ok=True)
+    datasets = orjson.loads(await datasource.fetch(source, "datasets"))
+    dataset_keys = [
+        str(dataset["datasetKey"])
+        for dataset in datasets
+        if not institution_keys or str(dataset["institutionKey"]) in institution_keys
+    ]
+    summary = {"scored": 0, "skipped": 0, "failed": 0, "relations": 0}
+    loop = asyncio.get_event_loop()
+    # bound the number of fetched datasets waiting for a process
+    semaphore = asyncio.Semaphore(processes * 2)
+
+    async def score(executor: ProcessPoolExecutor, manifest: utils.RunManifest, position: int, dataset_key: str) -> None:
+        path = directory / (Path(dataset_key).name + "." + output_format)
+        if path.name in manifest and path.exists():
+            summary["skipped"] += 1
+            return
+        async with semaphore:
+            try:
+                with utils.measure_time() as now:
+                    content = await datasource.fetch(source, "occurrences", params={"datasetKey": dataset_key})
+                    relation_count = await loop.run_in_executor(executor, score_dataset, content, str(path), output_format)
+            except Exception:
+                logger.exception("dataset %s", dataset_key)
+                summary["failed"] += 1
+                return
+        manifest.add(path.name)
+        summary["scored"] += 1
+        summary["relations"] += relation_count
+        logger.info("%i/%i dataset %s: %i relations in %.1fs", position + 1, len(dataset_keys), dataset_key, relation_count, now())
+
+    # spawn: the event loop and the data source have started threads, a forked process could deadlock on their locks
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as executor, \
+            utils.RunManifest(directory / RUN_MANIFEST, resume) as manifest:
+        await asyncio.gather(*(
+            score(executor, manifest, position, dataset_key)
+            for position, dataset_key in enumerate(dataset_keys)
+        ))
+    return summary
+
+
+def run_score(config, args) -> None:
+    if args.output_format == "parquet" and pyarrow is None:
+        raise SystemExit("the parquet format requires pyarrow")
+
+    async def run():
+        source = datasource.from_config(config)
+        await source.start()
+        try:
+            return await score_datasets(
+                source, Path(args.directory), args.institution_keys, args.processes, args.output_format, args.resume
+            )
+        finally:
+            await source.close()
+
+    with utils.measure_time() as now:
+        summary = asyncio.run(run())
+    elapsed = now()
+    logger.info(
+        "%i datasets scored, %i skipped (already scored by the resumed run), %i failed: %i relations in %.1fs (%.0f relations/s)",
+        summary["scored"], summary["skipped"], summary["failed"],
+        summary["relations"], elapsed, summary["relations"] / elapsed if elapsed > 0 else 0,
+    )
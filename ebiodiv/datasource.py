@@ -0,0 +1,337 @@
+"""
+Data sources: where the API reads the institutions, datasets and occurrences.
+
+* HttpDataSource: the upstream API at DATASOURCE["url"].
+* SnapshotDataSource: a local directory of gzip compressed JSON files, see take_snapshot:
+
+    institutionList.json.gz
+    institutions.json.gz
+    datasets.json.gz
+    index.json                          {"institutions": {institutionKey: [datasetKey, ...]}}
+    occurrences/<datasetKey>.json.gz
+    run-manifest.txt                    the files written by the last run of take_snapshot
+
+  The files are memory-mapped and decompressed when a request reads them.
+  The snapshot is read-only: the decisions can't be saved.
+
+DataSource.request returns an async context manager, the response has the same interface
+as an aiohttp response: status, headers and read().
+"""
+import abc
+import asyncio
+import gzip
+import logging
+import mmap
+import os
+import re
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+import orjson
+from multidict import CIMultiDict
+
+from . import utils
+
+
+__all__ = ['DataSource', 'HttpDataSource', 'SnapshotDataSource', 'from_config', 'fetch', 'take_snapshot', 'run_snapshot']
+
+
+logger = logging.getLogger(__name__)
+
+METADATA_ENDPOINTS = ("institutionList", "institutions", "datasets")
+
+# the files written by the last snapshot run, see utils.RunManifest
+RUN_MANIFEST = "run-manifest.txt"
+
+
+class DataSource(abc.ABC):
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def request(self, method: str, endpoint: str, params: Optional[Dict[str, str]] = None, json=None):
+        """Return an async context manager of the response"""
+
+
+## HTTP
+
+async def on_request_end(session, trace_config_ctx, params):
+    logger.info(f"\"{params.method} {params.url}\" {params.response.status} {params.response.headers.get('content-length', '')}")
+
+
+class HttpDataSource(DataSource):
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        """create HTTP client & log outgoing HTTP request"""
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        self.session = aiohttp.ClientSession(
+            trace_configs=[trace_config],
+            timeout=aiohttp.ClientTimeout(self.timeout),
+            headers={
+                'User-Agent': 'ebiodiv-backend'
+            },
+        )
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    def request(self, method: str, endpoint: str, params: Optional[Dict[str, str]] = None, json=None):
+        return self.session.request(method, self.url + endpoint, params=params, json=json)
+
+
+## SNAPSHOT
+
+def _read_gzip(path: Path) -> bytes:
+    """Decompress a gzip file through a memory map: the compressed file is not copied in memory"""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            return zlib.decompress(mapped_file, wbits=16 + zlib.MAX_WBITS)
+
+
+def _write_gzip(path: Path, content: bytes) -> None:
+    """Write the file atomically: a partial file is never read as a complete one"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(gzip.compress(content))
+    os.replace(tmp_path, path)
+
+
+def _merge_occurrences(contents: List[bytes], occurrence_keys: Optional[str]) -> bytes:
+    """Merge the occurrences of several datasets,
+    keep only the relations with at least one occurrence in occurrence_keys (comma separated).
+
+    subjectOccurrenceKeys is the union of the datasets ones, the other keys are copied from the first dataset with the key.
+    """
+    occurrences = {}
+    relations = {}
+    subject_occ_keys = None
+    other_items = {}
+    for content in contents:
+        data = orjson.loads(content)
+        occurrences.update(data["occurrences"])
+        for relation in data["occurrenceRelations"]:
+            relations[(relation["occurrenceKey1"], relation["occurrenceKey2"])] = relation
+        for key, value in data.items():
+            if key == "subjectOccurrenceKeys":
+                # dictionary as an ordered set
+                subject_occ_keys = subject_occ_keys or {}
+                subject_occ_keys.update(dict.fromkeys(value))
+            elif key not in ("occurrences", "occurrenceRelations"):
+                other_items.setdefault(key, value)
+    if occurrence_keys is not None:
+        selected_keys = {int(occ_key) for occ_key in occurrence_keys.split(",") if occ_key.strip()}
+        relations = {
+            key: relation
+            for key, relation in relations.items()
+            if key[0] in selected_keys or key[1] in selected_keys
+        }
+        occurrences = {
+            str(occ_key): occurrences[str(occ_key)]
+            for key in relations
+            for occ_key in key
+        }
+    if subject_occ_keys is not None:
+        other_items["subjectOccurrenceKeys"] = [occ_key for occ_key in subject_occ_keys if str(occ_key) in occurrences]
+    return orjson.dumps({
+        "occurrences": occurrences,
+        "occurrenceRelations": list(relations.values()),
+        **other_items,
+    })
+
+
+class SnapshotResponse:
+
+    def __init__(self, status: int, content: bytes, media_type: str = "application/json"):
+        self.status = status
+        self.content = content
+        self.headers = CIMultiDict({
+            "Content-Type": media_type,
+            "Content-Length": str(len(content)),
+        })
+
+    async def read(self) -> bytes:
+        return self.content
+
+
+def _error(status: int, message: str) -> SnapshotResponse:
+    return SnapshotResponse(status, orjson.dumps({"error": message}))
+
+
+class SnapshotDataSource(DataSource):
+
+    def __init__(self, directory: str, cache_size: int):
+        self.directory = Path(directory)
+        self.cache_size = cache_size
+        # decompressed files, the least recently used are removed
+        self._cache: "OrderedDict[Path, bytes]" = OrderedDict()
+        self.institutions: Dict[str, List[str]] = {}
+
+    async def start(self) -> None:
+        index = orjson.loads((self.directory / "index.json").read_bytes())
+        self.institutions = index["institutions"]
+        logger.info("Snapshot %s: %i institutions", self.directory, len(self.institutions))
+
+    async def _read(self, path: Path) -> Optional[bytes]:
+        content = self._cache.get(path)
+        if content is not None:
+            self._cache.move_to_end(path)
+            return content
+        if not path.exists():
+            return None
+        content = await asyncio.get_event_loop().run_in_executor(None, _read_gzip, path)
+        self._cache[path] = content
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return content
+
+    def _get_dataset_path(self, dataset_key: str) -> Path:
+        # the dataset key comes from the query string
+        return self.directory / "occurrences" / (Path(dataset_key).name + ".json.gz")
+
+    async def _get(self, endpoint: str, params: Dict[str, str]) -> SnapshotResponse:
+        if endpoint in METADATA_ENDPOINTS:
+            content = await self._read(self.directory / (endpoint + ".json.gz"))
+            if content is None:
+                return _error(404, f"{endpoint} not in the snapshot")
+            institution_key = params.get("institutionKey")
+            if endpoint == "datasets" and institution_key:
+                datasets = orjson.loads(content)
+                content = orjson.dumps([
+                    dataset for dataset in datasets if str(dataset.get("institutionKey")) == institution_key
+                ])
+            return SnapshotResponse(200, content)
+
+        if endpoint == "occurrences":
+            if "datasetKey" in params:
+                # the frontend joins the dataset keys with "+", which the query string decodes as spaces
+                dataset_keys = [dataset_key for dataset_key in re.split(r"[\s+]+", params["datasetKey"]) if dataset_key]
+                if not dataset_keys:
+                    return _error(400, "datasetKey is empty")
+            elif "institutionKey" in params:
+                dataset_keys = self.institutions.get(params["institutionKey"])
+                if dataset_keys is None:
+                    return _error(404, "institution not in the snapshot")
+            else:
+                return _error(400, "datasetKey or institutionKey is required in snapshot mode")
+            contents = []
+            for dataset_key in dataset_keys:
+                content = await self._read(self._get_dataset_path(dataset_key))
+                if content is None:
+                    return _error(404, f"dataset {dataset_key} not in the snapshot")
+                contents.append(content)
+            if len(contents) == 1 and "occurrenceKeys" not in params:
+                return SnapshotResponse(200, contents[0])
+            content = await asyncio.get_event_loop().run_in_executor(
+                None, _merge_occurrences, contents, params.get("occurrenceKeys")
+            )
+            return SnapshotResponse(200, content)
+
+        return _error(404, f"{endpoint} not in the snapshot")
+
+    @asynccontextmanager
+    async def request(self, method: str, endpoint: str, params: Optional[Dict[str, str]] = None, json=None):
+        if method.lower() != "get":
+            yield _error(405, "the snapshot is read-only")
+        else:
+            yield await self._get(endpoint, params or {})
+
+
+def from_config(config) -> DataSource:
+    if config.get("type", "http") == "snapshot":
+        return SnapshotDataSource(config["snapshot_directory"], int(config["snapshot_cache_size"]))
+    return HttpDataSource(config["url"], float(config["timeout"]))
+
+
+## TAKE A SNAPSHOT
+
+async def fetch(source: DataSource, endpoint: str, params: Optional[Dict[str, str]] = None) -> bytes:
+    """Return the content of a GET request, raise RuntimeError if the status is not 200"""
+    async with source.request("get", endpoint, params=params) as response:
+        content = await response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{endpoint} {params}: status {response.status}")
+        return content
+
+
+async def take_snapshot(
+    source: DataSource, directory: Path, institution_keys: Optional[List[str]], concurrency: int, resume: bool = False
+) -> None:
+    """Save the upstream data into directory.
+
+    All the files are fetched again, except with resume: the files already fetched by the interrupted run
+    (see RUN_MANIFEST) are kept.
+    """
+    (directory / "occurrences").mkdir(parents=True, exist_ok=True)
+    with utils.RunManifest(directory / RUN_MANIFEST, resume) as manifest:
+        for endpoint in METADATA_ENDPOINTS:
+            path = directory / (endpoint + ".json.gz")
+            if path.name in manifest and path.exists():
+                if endpoint == "datasets":
+                    datasets = orjson.loads(_read_gzip(path))
+                continue
+            content = await fetch(source, endpoint)
+            _write_gzip(path, content)
+            manifest.add(path.name)
+            if endpoint == "datasets":
+                datasets = orjson.loads(content)
+
+        institutions = {}
+        for dataset in datasets:
+            institution_key = str(dataset["institutionKey"])
+            if institution_keys and institution_key not in institution_keys:
+                continue
+            institutions.setdefault(institution_key, []).append(str(dataset["datasetKey"]))
+
+        semaphore = asyncio.Semaphore(concurrency)
+        dataset_keys = [dataset_key for dataset_keys in institutions.values() for dataset_key in dataset_keys]
+
+        async def fetch_dataset(position: int, dataset_key: str) -> None:
+            path = directory / "occurrences" / (dataset_key + ".json.gz")
+            name = "occurrences/" + path.name
+            if name in manifest and path.exists():
+                return
+            async with semaphore:
+                with utils.measure_time() as now:
+                    content = await fetch(source, "occurrences", params={"datasetKey": dataset_key})
+                    _write_gzip(path, content)
+                manifest.add(name)
+                logger.info("%i/%i dataset %s: %i bytes in %.1fs", position + 1, len(dataset_keys), dataset_key, len(content), now())
+
+        await asyncio.gather(*(fetch_dataset(position, dataset_key) for position, dataset_key in enumerate(dataset_keys)))
+    # written last: a snapshot with an index is complete.
+    # the institutions of the previous runs (i.e. other --institutionKey) are kept
+    index_path = directory / "index.json"
+    if index_path.exists():
+        index = orjson.loads(index_path.read_bytes())
+        index["institutions"].update(institutions)
+    else:
+        index = {"institutions": institutions}
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    tmp_path.write_bytes(orjson.dumps(index))
+    os.replace(tmp_path, index_path)
+
+
+def run_snapshot(config, args) -> None:
+    async def run():
+        source = HttpDataSource(config["url"], float(config["timeout"]))
+        await source.start()
+        try:
+            await take_snapshot(source, Path(args.directory), args.institution_keys, args.concurrency, args.resume)
+        finally:
+            await source.close()
+
+    asyncio.run(run())
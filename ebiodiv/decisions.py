@@ -0,0 +1,264 @@
+"""
+Write-behind queue of the occurrenceRelations decisions.
+
+A decision is acknowledged once it is written in a local journal. The pending decisions are
+coalesced per (occurrenceKey1, occurrenceKey2), the last one wins, and they are sent to the
+upstream in batches: every flush_interval seconds, or as soon as batch_size decisions are pending.
+On upstream errors, the batch is sent again with an exponential backoff.
+A batch rejected by the upstream (4xx status) is split in halves until the rejected decisions are found:
+they are written in the dead letter journal (dead-letter.jsonl), the other decisions are sent.
+
+Each worker owns a journal file in the journal directory, locked while the worker runs.
+On startup, a worker adopts the journals of the workers which have stopped before sending
+all their decisions (the journals which are not locked).
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the journals of the other workers are not adopted
+    fcntl = None
+
+
+__all__ = ['is_valid_relation', 'DecisionQueue']
+
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PREFIX = "decisions-"
+JOURNAL_SUFFIX = ".jsonl"
+LOCK_SUFFIX = ".lock"
+DEAD_LETTER_NAME = "dead-letter.jsonl"
+DECISION_VALUES = (True, False, None)
+
+
+def _get_relation_key(relation: dict) -> Tuple:
+    return relation["occurrenceKey1"], relation["occurrenceKey2"]
+
+
+def _is_occurrence_key(value) -> bool:
+    # bool is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_valid_relation(relation) -> bool:
+    """Check a relation before it is acknowledged"""
+    return (
+        isinstance(relation, dict)
+        and _is_occurrence_key(relation.get("occurrenceKey1"))
+        and _is_occurrence_key(relation.get("occurrenceKey2"))
+        and "decision" in relation
+        and any(relation["decision"] is value for value in DECISION_VALUES)
+    )
+
+
+def _read_journal(journal_path: Path) -> List[dict]:
+    relations = []
+    with open(journal_path, "rb") as f:
+        for line in f:
+            try:
+                relations.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                # the worker has stopped while writing this line: the decision was not acknowledged
+                logger.warning("%s: ignore invalid line %r", journal_path, line)
+    return relations
+
+
+class DecisionQueue:
+
+    def __init__(
+        self,
+        journal_directory: str,
+        flush_interval: float,
+        batch_size: int,
+        min_retry_delay: float,
+        max_retry_delay: float,
+        send: Callable[[List[dict]], Awaitable[int]],
+    ):
+        """send: coroutine function which posts a list of relations to the upstream, returns the HTTP status"""
+        self.journal_directory = Path(journal_directory)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.send = send
+        # insertion order = order of the first pending decision on each relation
+        self.pending: Dict[Tuple, dict] = {}
+        self.journal_path = self.journal_directory / (JOURNAL_PREFIX + str(os.getpid()) + JOURNAL_SUFFIX)
+        self._journal = None
+        self._lock = None
+        self._flush_event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config, send: Callable[[List[dict]], Awaitable[int]]) -> "DecisionQueue":
+        return cls(
+            journal_directory=config["journal_directory"],
+            flush_interval=float(config["flush_interval"]),
+            batch_size=int(config["batch_size"]),
+            min_retry_delay=float(config["min_retry_delay"]),
+            max_retry_delay=float(config["max_retry_delay"]),
+            send=send,
+        )
+
+    # journal
+
+    def _lock_journal(self, journal_path: Path, blocking: bool):
+        """Return the opened lock file, or None if another worker holds the lock"""
+        lock = open(journal_path.with_suffix(LOCK_SUFFIX), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                lock.close()
+                return None
+        return lock
+
+    def _adopt_journals(self) -> None:
+        if fcntl is None:
+            return
+        for journal_path in sorted(self.journal_directory.glob(JOURNAL_PREFIX + "*" + JOURNAL_SUFFIX)):
+            if journal_path == self.journal_path:
+                continue
+            lock = self._lock_journal(journal_path, blocking=False)
+            if lock is None:
+                # the worker is running
+                continue
+            try:
+                if not journal_path.exists():
+                    # adopted by another worker
+                    continue
+                relations = _read_journal(journal_path)
+                logger.info("Adopt %i decision(s) from %s", len(relations), journal_path)
+                self._coalesce(relations)
+                # the decisions must be in our journal before the other journal is removed
+                self._rewrite_journal()
+                journal_path.unlink()
+            finally:
+                lock.close()
+            try:
+                journal_path.with_suffix(LOCK_SUFFIX).unlink()
+            except FileNotFoundError:
+                pass
+
+    def _rewrite_journal(self) -> None:
+        """Replace the journal by the pending decisions"""
+        tmp_path = self.journal_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            for relation in self.pending.values():
+                f.write(orjson.dumps(relation) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal is not None:
+            self._journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, "ab")
+
+    def _append_journal(self, relations: List[dict]) -> None:
+        self._journal.write(b"".join(orjson.dumps(relation) + b"\n" for relation in relations))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _write_dead_letters(self, relations: List[dict]) -> None:
+        with open(self.journal_directory / DEAD_LETTER_NAME, "ab") as f:
+            f.write(b"".join(orjson.dumps(relation) + b"\n" for relation in relations))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _coalesce(self, relations: Iterable[dict]) -> None:
+        for relation in relations:
+            self.pending[_get_relation_key(relation)] = relation
+
+    # queue
+
+    async def start(self) -> None:
+        self.journal_directory.mkdir(parents=True, exist_ok=True)
+        self._lock = self._lock_journal(self.journal_path, blocking=True)
+        if self.journal_path.exists():
+            # the process ID of a stopped worker has been reused
+            self._coalesce(_read_journal(self.journal_path))
+        self._rewrite_journal()
+        self._adopt_journals()
+        self._flush_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float) -> None:
+        """Try to send the pending decisions, the journal keeps the ones which are not sent"""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except Exception:
+            logger.exception("%i decision(s) not sent, kept in %s", len(self.pending), self.journal_path)
+        self._journal.close()
+        if self.pending:
+            self._lock.close()
+        else:
+            self.journal_path.unlink()
+            self._lock.close()
+            self.journal_path.with_suffix(LOCK_SUFFIX).unlink()
+
+    def put(self, relations: List[dict]) -> None:
+        """Acknowledge the decisions: the decisions are in the journal when this method returns"""
+        self._append_journal(relations)
+        self._coalesce(relations)
+        if len(self.pending) >= self.batch_size:
+            self._flush_event.set()
+
+    async def _send_batch(self, batch: List[Tuple[Tuple, dict]]) -> None:
+        status = await self.send([relation for _, relation in batch])
+        if status >= 500:
+            raise RuntimeError(f"upstream status {status}")
+        if status >= 400:
+            # retrying won't help: find the rejected decisions
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await self._send_batch(batch[:middle])
+                await self._send_batch(batch[middle:])
+                return
+            logger.error("upstream status %i, decision moved to %s: %r", status, DEAD_LETTER_NAME, batch[0][1])
+            self._write_dead_letters([batch[0][1]])
+        # a decision received during self.send stays pending
+        for key, relation in batch:
+            if self.pending.get(key) is relation:
+                del self.pending[key]
+
+    async def flush(self) -> None:
+        """Send all the pending decisions. Raise an exception on upstream errors"""
+        while self.pending:
+            try:
+                await self._send_batch(list(self.pending.items())[:self.batch_size])
+            finally:
+                # the sent decisions are removed from the journal, even if a part of the batch failed
+                self._rewrite_journal()
+
+    async def _run(self) -> None:
+        retry_delay = self.min_retry_delay
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+                retry_delay = self.min_retry_delay
+            except Exception:
+                logger.exception("%i decision(s) not sent, retry in %s seconds", len(self.pending), retry_delay)
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    def gauges(self) -> Dict[str, int]:
+        return {
+            "pending": len(self.pending),
+        }
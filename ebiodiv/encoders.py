@@ -0,0 +1,186 @@
+"""
+Encodings of the scored occurrences.
+
+JSON is the default. The relations and their scores are a regular table, so the binary
+encodings store them as columns (one typed column per score):
+* MessagePack: {"occurrences": {...}, "occurrenceRelations": {column: [...]}, "scores": {label: [...]}}
+* Apache Arrow: two IPC streams, one after the other in the response.
+  The first one has one row per relation, the second one has one row per occurrence:
+  an "occurrenceKey" column, then one column per occurrence field (a field whose values
+  don't have a common Arrow type is a column of JSON strings).
+  With pyarrow, call pyarrow.ipc.open_stream twice on the same input stream.
+
+The other keys (i.e. "total", "offset", "limit") are copied as is in the MessagePack document,
+and as JSON in the schema metadata of the first Arrow stream.
+
+msgpack and pyarrow are optional: without them, the client receives JSON.
+
+encode_json_in_slices encodes the JSON document on the event loop, in slices (cooperative mode).
+"""
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+import orjson
+
+from . import matchingalgorithm, scheduling
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+__all__ = ['MEDIA_TYPE_JSON', 'MEDIA_TYPE_MSGPACK', 'MEDIA_TYPE_ARROW', 'get_available_media_types', 'negotiate', 'encode', 'encode_json_in_slices']
+
+
+MEDIA_TYPE_JSON = "application/json"
+MEDIA_TYPE_MSGPACK = "application/msgpack"
+MEDIA_TYPE_ARROW = "application/vnd.apache.arrow.stream"
+
+MEDIA_TYPE_ALIASES = {
+    "application/x-msgpack": MEDIA_TYPE_MSGPACK,
+    "application/vnd.msgpack": MEDIA_TYPE_MSGPACK,
+}
+
+
+def get_available_media_types() -> List[str]:
+    media_types = [MEDIA_TYPE_JSON]
+    if msgpack is not None:
+        media_types.append(MEDIA_TYPE_MSGPACK)
+    if pyarrow is not None:
+        media_types.append(MEDIA_TYPE_ARROW)
+    return media_types
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """Return the available media type preferred by the Accept header, JSON by default"""
+    if not accept:
+        return MEDIA_TYPE_JSON
+    available = get_available_media_types()
+    candidates = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        media_type = MEDIA_TYPE_ALIASES.get(media_type.lower(), media_type.lower())
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0 and media_type in available:
+            candidates.append((-quality, position, media_type))
+    if not candidates:
+        return MEDIA_TYPE_JSON
+    return min(candidates)[2]
+
+
+def _get_relation_columns(relations: List[dict]) -> Dict[str, list]:
+    """Columns of the relations, except the scores"""
+    names = {}
+    for relation in relations:
+        for name in relation:
+            if name != "scores":
+                names.setdefault(name)
+    return {name: [relation.get(name) for relation in relations] for name in names}
+
+
+def _get_other_items(data) -> dict:
+    return {key: value for key, value in data.items() if key not in ("occurrences", "occurrenceRelations")}
+
+
+def encode_msgpack(data, score_matrix: np.ndarray) -> bytes:
+    scores = {
+        label: [None if value != value else value for value in column]
+        for label, column in zip(matchingalgorithm.SCORE_LABELS, score_matrix.T.tolist())
+    }
+    return msgpack.packb({
+        **_get_other_items(data),
+        "occurrences": data["occurrences"],
+        "occurrenceRelations": _get_relation_columns(data["occurrenceRelations"]),
+        "scores": scores,
+    })
+
+
+def _get_occurrence_batch(occurrences: Dict[str, dict]):
+    names = {}
+    for occ in occurrences.values():
+        for name in occ:
+            names.setdefault(name)
+    arrays = [pyarrow.array([int(occ_key) for occ_key in occurrences], type=pyarrow.int64())]
+    for name in names:
+        column = [occ.get(name) for occ in occurrences.values()]
+        try:
+            arrays.append(pyarrow.array(column))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # mixed types
+            arrays.append(pyarrow.array([None if value is None else orjson.dumps(value).decode() for value in column]))
+    return pyarrow.RecordBatch.from_arrays(arrays, names=["occurrenceKey", *names])
+
+
+def _write_stream(sink, batch) -> None:
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+
+
+def encode_arrow(data, score_matrix: np.ndarray) -> bytes:
+    arrays = []
+    names = []
+    for name, column in _get_relation_columns(data["occurrenceRelations"]).items():
+        arrays.append(pyarrow.array(column))
+        names.append(name)
+    for label, column in zip(matchingalgorithm.SCORE_LABELS, score_matrix.T):
+        arrays.append(pyarrow.array(column, mask=np.isnan(column)))
+        names.append("scores." + label)
+    batch = pyarrow.RecordBatch.from_arrays(arrays, names=names)
+    metadata = {key: orjson.dumps(value) for key, value in _get_other_items(data).items()}
+    if metadata:
+        batch = batch.replace_schema_metadata(metadata)
+
+    sink = pyarrow.BufferOutputStream()
+    _write_stream(sink, batch)
+    _write_stream(sink, _get_occurrence_batch(data["occurrences"]))
+    return sink.getvalue().to_pybytes()
+
+
+def encode(media_type: str, data, score_matrix: np.ndarray) -> bytes:
+    """Encode the scored occurrences. For JSON, the scores must already be in data"""
+    if media_type == MEDIA_TYPE_MSGPACK:
+        return encode_msgpack(data, score_matrix)
+    if media_type == MEDIA_TYPE_ARROW:
+        return encode_arrow(data, score_matrix)
+    return orjson.dumps(data)
+
+
+async def encode_json_in_slices(data, slice_budget: float) -> bytes:
+    """Same output as encode(MEDIA_TYPE_JSON, data, ...), the occurrences and the relations are encoded in slices"""
+    occurrence_parts = []
+    relation_parts = []
+    # orjson.dumps({...})[1:-1] and orjson.dumps([...])[1:-1]: the items without the brackets
+    await scheduling.run_in_slices(
+        lambda items: occurrence_parts.append(orjson.dumps(dict(items))[1:-1]),
+        list(data["occurrences"].items()),
+        slice_budget,
+        math.inf,
+    )
+    await scheduling.run_in_slices(
+        lambda relations: relation_parts.append(orjson.dumps(relations)[1:-1]),
+        data["occurrenceRelations"],
+        slice_budget,
+        math.inf,
+    )
+    parts = [
+        b'"occurrences":{' + b",".join(occurrence_parts) + b"}",
+        b'"occurrenceRelations":[' + b",".join(relation_parts) + b"]",
+    ]
+    other_items = _get_other_items(data)
+    if other_items:
+        parts.append(orjson.dumps(other_items)[1:-1])
+    return b"{" + b",".join(parts) + b"}"
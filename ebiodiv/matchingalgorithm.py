@@ -11,10 +11,10 @@ import datetime
 import re
 from typing import Optional, Tuple, List, Dict, FrozenSet
 from collections import namedtuple
+from itertools import chain
 
 import jaro
 import numpy as np
-import numpy.ma as ma
 
 
 """Normalization of the occurrences"""
@@ -177,7 +177,7 @@ def get_score_numeric(subject_value, related_value):
 
         if max_value == 0:
             # all values are either 0 or None
-            return [1 if candidate is not None else None for candidate in candidates]
+            return 1 if related_value is not None else np.nan
 
         result = [1 - (abs(candidate - subject_value) / max_value) if candidate is not None else np.nan for candidate in candidates]
     return result[0]
@@ -269,40 +269,60 @@ def get_score_elevationdepth(subject_occ, related_occ):
     return get_score_numeric(subject_occ['elevation'], related_occ['elevation'])
 
 
-def get_scores(subject_occ, related_occ):
-    # row: field, column: occurrences
-    score_values = []
-    labels = []
-    weights = []
+def get_score_row(subject_occ, related_occ, out) -> None:
+    """Write the field scores between two occurrences into ``out``, in the SCORE_LABELS order.
 
-    #
+    The last item of ``out`` (the global score) is not written.
+    """
+    i = 0
     for field_name, field_desc in FIELDS.items():
-        subject_value = subject_occ[field_name]
-        related_value = related_occ[field_name]
-        score_values.append([field_desc.get_score(subject_value, related_value)])
-        labels.append(field_name)
-        weights.append(field_desc.score_weight)
+        out[i] = field_desc.get_score(subject_occ[field_name], related_occ[field_name])
+        i += 1
+    for field_desc in MULTI_FIELDS.values():
+        out[i] = field_desc.get_score(subject_occ, related_occ)
+        i += 1
 
-    for field_names, field_desc in MULTI_FIELDS.items():
-        score_values.append([field_desc.get_score(subject_occ, related_occ)])
-        labels.append(field_names[0])
-        weights.append(field_desc.score_weight)
-
-    score_array = np.array(score_values)
-    # calculate the global score = weight average
-    # use masked_invalid to use ma.average with some np.nan in score_array
-    score_average = ma.average(ma.masked_invalid(score_array), axis=0, weights=weights)
-    # add score to the array
-    labels.append("$global")
-    score_array = np.append(score_array, [score_average], axis=0)
-    #
-    score_array = np.around(score_array, decimals=3)
-
-    # iterate over occurrences using score_array.transpose()
-    result = []
-    for row in score_array.transpose():
-        result.append({key: None if np.isnan(value) else value for key, value in zip(labels, row.tolist())})
-    return result[0]
+
+def get_score_matrix(occurrence_pairs, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Score a list of (subject_occ, related_occ) pairs.
+
+    Fill one matrix in place (row: pair, column: SCORE_LABELS), without any intermediate
+    array per pair. The last column is the global score: the weighted average of the
+    other columns, np.nan values are ignored.
+
+    ``out`` is an optional preallocated float matrix with at least len(occurrence_pairs) rows.
+    """
+    occurrence_pairs = list(occurrence_pairs)
+    if out is None:
+        out = np.empty((len(occurrence_pairs), len(SCORE_LABELS)), dtype=np.float64)
+    else:
+        out = out[:len(occurrence_pairs)]
+
+    for row, (subject_occ, related_occ) in zip(out, occurrence_pairs):
+        get_score_row(subject_occ, related_occ, row)
+
+    # global score = sum(weight * score) / sum(weight) for the defined scores
+    field_scores = out[:, :-1]
+    global_scores = out[:, -1]
+    weight_sum = (~np.isnan(field_scores)) @ SCORE_WEIGHTS
+    np.nansum(field_scores * SCORE_WEIGHTS, axis=1, out=global_scores)
+    np.divide(global_scores, weight_sum, out=global_scores, where=weight_sum > 0)
+    global_scores[weight_sum == 0] = np.nan
+
+    np.around(out, decimals=3, out=out)
+    return out
+
+
+def score_matrix_to_dicts(score_matrix: np.ndarray) -> List[Dict[str, Optional[float]]]:
+    """Convert the rows of a score matrix to {label: score} dictionaries, np.nan becomes None"""
+    return [
+        {label: None if value != value else value for label, value in zip(SCORE_LABELS, row)}
+        for row in score_matrix.tolist()
+    ]
+
+
+def get_scores(subject_occ, related_occ):
+    return score_matrix_to_dicts(get_score_matrix([(subject_occ, related_occ)]))[0]
 
 
 # matching algorithm: which columns
@@ -331,3 +351,12 @@ MULTI_FIELDS = {
     ("year", "month", "day"): FieldDescription(1, normalize_yearmonthday, get_score_yearmonthday),
     ("decimalLatitude", "decimalLongitude"): FieldDescription(2, normalize_latlon, get_score_latlon),
 }
+
+
+# scores returned by get_scores, in the column order of get_score_matrix
+SCORE_LABELS = [*FIELDS, *(field_names[0] for field_names in MULTI_FIELDS), "$global"]
+
+SCORE_WEIGHTS = np.array(
+    [field_desc.score_weight for field_desc in chain(FIELDS.values(), MULTI_FIELDS.values())],
+    dtype=np.float64,
+)
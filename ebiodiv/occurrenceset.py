@@ -0,0 +1,305 @@
+"""
+Decoded occurrences of an institution or a dataset, kept between requests.
+
+An OccurrenceSet holds the upstream response, the normalized copies of the occurrences
+and the scores of the relations computed so far: a request for a window of relations
+scores only the relations of this window which have never been scored.
+
+Once all the relations are scored, the ranking index (relations sorted by global score)
+answers the "top N relations with a score >= x" queries without scoring.
+When the occurrences are fetched again, the scores of the relations whose occurrences
+have not changed are copied from the previous OccurrenceSet. Once expired, a cached
+OccurrenceSet is replaced by its PreviousScores for previous_ttl seconds, then removed.
+"""
+from collections import OrderedDict
+from time import time
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from . import matchingalgorithm
+from .admission import MB
+
+
+__all__ = ['normalize_occurrences', 'filter_occurrence_keys', 'OccurrenceSet', 'PreviousScores', 'OccurrenceSetCache']
+
+
+def normalize_occurrences(items: Iterable[Tuple[str, dict]]) -> Dict[int, dict]:
+    """Normalize a copy of the (occurrence key, occurrence) items, leave the original occurrences untouched"""
+    normalized_occ_dict = {}
+    for occ_key, occ in items:
+        normalized_occ = occ.copy()
+        matchingalgorithm.normalize_occurrence(normalized_occ)
+        normalized_occ_dict[int(occ_key)] = normalized_occ
+    return normalized_occ_dict
+
+
+def filter_occurrence_keys(occ_keys, occurrences: Dict[str, dict]):
+    """Keep the occurrence keys (list or dictionary keys) of occurrences"""
+    if isinstance(occ_keys, dict):
+        return {occ_key: value for occ_key, value in occ_keys.items() if str(occ_key) in occurrences}
+    return [occ_key for occ_key in occ_keys if str(occ_key) in occurrences]
+
+
+class OccurrenceSet:
+
+    def __init__(
+        self,
+        data: dict,
+        content_length: int = 0,
+        previous: Optional[Union["OccurrenceSet", "PreviousScores"]] = None,
+        normalized_occ_dict: Optional[Dict[int, dict]] = None,
+    ):
+        self.data = data
+        self.content_length = content_length
+        self.created = time()
+        self.relations: List[dict] = data["occurrenceRelations"]
+        self.relation_index: Dict[tuple, int] = {
+            (relation["occurrenceKey1"], relation["occurrenceKey2"]): i
+            for i, relation in enumerate(self.relations)
+        }
+
+        if normalized_occ_dict is None:
+            normalized_occ_dict = normalize_occurrences(data["occurrences"].items())
+        self.normalized_occ_dict = normalized_occ_dict
+
+        self.score_matrix = np.full((len(self.relations), len(matchingalgorithm.SCORE_LABELS)), np.nan)
+        self.scored = np.zeros(len(self.relations), dtype=bool)
+        if previous is not None:
+            self._copy_scores(previous)
+
+        # relation indices sorted by descending global score, see get_ranking
+        self.ranking: Optional[np.ndarray] = None
+        self.ranked_global_scores: Optional[np.ndarray] = None
+
+    def _copy_scores(self, previous: Union["OccurrenceSet", "PreviousScores"]) -> None:
+        """Copy the scores of the relations whose occurrences have not changed"""
+        unchanged_occ_keys = self.get_unchanged_occ_keys(previous, self.normalized_occ_dict.keys())
+        self.copy_scores(previous, unchanged_occ_keys, range(len(self.relations)))
+
+    def get_unchanged_occ_keys(self, previous: Union["OccurrenceSet", "PreviousScores"], occ_keys: Iterable[int]) -> Set[int]:
+        """The occurrence keys whose normalized occurrence is the same in previous"""
+        return {
+            occ_key
+            for occ_key in occ_keys
+            if previous.normalized_occ_dict.get(occ_key) == self.normalized_occ_dict[occ_key]
+        }
+
+    def copy_scores(self, previous: Union["OccurrenceSet", "PreviousScores"], unchanged_occ_keys: Set[int], indices: Iterable[int]) -> None:
+        """Copy the scores of the relations at indices whose occurrences are in unchanged_occ_keys"""
+        copied_indices = []
+        previous_indices = []
+        for i in indices:
+            relation = self.relations[i]
+            occ_key1, occ_key2 = relation["occurrenceKey1"], relation["occurrenceKey2"]
+            j = previous.relation_index.get((occ_key1, occ_key2))
+            if j is not None and previous.scored[j] and occ_key1 in unchanged_occ_keys and occ_key2 in unchanged_occ_keys:
+                copied_indices.append(i)
+                previous_indices.append(j)
+        self.score_matrix[copied_indices] = previous.score_matrix[previous_indices]
+        self.scored[copied_indices] = True
+
+    def __len__(self):
+        return len(self.relations)
+
+    def get_missing(self, indices: np.ndarray) -> np.ndarray:
+        """Indices of the relations which have not been scored"""
+        return indices[~self.scored[indices]]
+
+    def score(self, indices: np.ndarray) -> None:
+        """Score the relations at indices"""
+        if len(indices) == 0:
+            return
+        self.score_matrix[indices] = matchingalgorithm.get_score_matrix(
+            (
+                self.normalized_occ_dict[self.relations[i]["occurrenceKey1"]],
+                self.normalized_occ_dict[self.relations[i]["occurrenceKey2"]],
+            )
+            for i in indices.tolist()
+        )
+        self.scored[indices] = True
+
+    def get_score_matrix(self, indices: np.ndarray) -> np.ndarray:
+        """Scores of the relations at indices, the missing scores are computed"""
+        self.score(self.get_missing(indices))
+        return self.score_matrix[indices]
+
+    def get_ranking(self) -> np.ndarray:
+        """Indices of all the relations sorted by descending global score, the relations without global score are last.
+
+        Score all the relations the first time.
+        """
+        if self.ranking is None:
+            global_scores = self.get_score_matrix(np.arange(len(self.relations)))[:, -1]
+            # np.argsort puts np.nan last
+            ranking = np.argsort(-global_scores, kind="stable")
+            self.ranked_global_scores = global_scores[ranking]
+            self.ranking = ranking
+        return self.ranking
+
+    def get_sorted_indices(self, descending: bool) -> np.ndarray:
+        """Indices of all the relations sorted by global score, the relations without global score are last"""
+        ranking = self.get_ranking()
+        if descending:
+            return ranking
+        defined_count = np.count_nonzero(~np.isnan(self.ranked_global_scores))
+        return np.concatenate((ranking[:defined_count][::-1], ranking[defined_count:]))
+
+    def get_top(self, n: int, min_score: float, min_field_scores: Dict[str, float]) -> Tuple[np.ndarray, int]:
+        """Indices of the n relations with the highest global score,
+        with a global score >= min_score and the field scores >= min_field_scores (a missing field score doesn't match).
+
+        Return the indices and the number of relations matching the thresholds.
+        """
+        ranking = self.get_ranking()
+        # -ranked_global_scores is sorted ascending, np.nan last
+        candidates = ranking[:np.searchsorted(-self.ranked_global_scores, -min_score, side="right")]
+        if min_field_scores:
+            columns = [matchingalgorithm.SCORE_LABELS.index(label) for label in min_field_scores]
+            thresholds = np.array(list(min_field_scores.values()))
+            candidates = candidates[np.all(self.score_matrix[candidates][:, columns] >= thresholds, axis=1)]
+        return candidates[:n], len(candidates)
+
+    def get_relations(self, indices: np.ndarray, with_scores: bool = False) -> List[dict]:
+        """Relations at indices, with the "scores" dictionary if with_scores (the relations must be scored).
+
+        The relations are copied, so the "scores" are not added to the cached relations.
+        """
+        relations = [self.relations[i] for i in indices.tolist()]
+        if with_scores:
+            score_dicts = matchingalgorithm.score_matrix_to_dicts(self.score_matrix[indices])
+            relations = [dict(relation, scores=scores) for relation, scores in zip(relations, score_dicts)]
+        return relations
+
+    def get_occurrences(self, relations: Iterable[dict]) -> Dict[str, dict]:
+        """The occurrences referenced by relations"""
+        occurrences = {}
+        all_occurrences = self.data["occurrences"]
+        for relation in relations:
+            for occ_key in (str(relation["occurrenceKey1"]), str(relation["occurrenceKey2"])):
+                occurrences[occ_key] = all_occurrences[occ_key]
+        return occurrences
+
+    def get_other_items(self, occurrences: Dict[str, dict]) -> dict:
+        """The other keys of the upstream response (i.e. subjectOccurrenceKeys) for a window with these occurrences.
+
+        subjectOccurrenceKeys is filtered on the occurrences of the window.
+        """
+        other_items = {
+            key: value
+            for key, value in self.data.items()
+            if key not in ("occurrences", "occurrenceRelations")
+        }
+        subject_occ_keys = other_items.get("subjectOccurrenceKeys")
+        if subject_occ_keys is not None and occurrences is not self.data["occurrences"]:
+            other_items["subjectOccurrenceKeys"] = filter_occurrence_keys(subject_occ_keys, occurrences)
+        return other_items
+
+    def get_window(self, indices: np.ndarray, with_scores: bool = False) -> dict:
+        """Relations at indices, the occurrences they reference and the other keys of the upstream response,
+        see get_relations and get_other_items"""
+        relations = self.get_relations(indices, with_scores)
+        if len(relations) == len(self.relations):
+            occurrences = self.data["occurrences"]
+        else:
+            occurrences = self.get_occurrences(relations)
+        return {
+            "occurrences": occurrences,
+            "occurrenceRelations": relations,
+            **self.get_other_items(occurrences),
+        }
+
+    def update_decisions(self, relations: Iterable[dict]) -> None:
+        """Copy the decisions sent to the upstream"""
+        for relation in relations:
+            i = self.relation_index.get((relation.get("occurrenceKey1"), relation.get("occurrenceKey2")))
+            if i is not None:
+                self.relations[i]["decision"] = relation.get("decision")
+
+    def get_previous_scores(self) -> "PreviousScores":
+        return PreviousScores(self)
+
+
+class PreviousScores:
+    """What OccurrenceSet._copy_scores reads from an expired OccurrenceSet, without the upstream response"""
+
+    def __init__(self, occurrence_set: OccurrenceSet):
+        self.content_length = occurrence_set.content_length
+        self.created = occurrence_set.created
+        self.relation_index = occurrence_set.relation_index
+        self.normalized_occ_dict = occurrence_set.normalized_occ_dict
+        self.score_matrix = occurrence_set.score_matrix
+        self.scored = occurrence_set.scored
+
+
+class OccurrenceSetCache:
+    """LRU cache of the OccurrenceSet, the entries expire after ttl seconds.
+    The PreviousScores of an expired entry are kept previous_ttl more seconds.
+
+    The cache is bounded by the number of entries and by their estimated memory (in bytes).
+    """
+
+    def __init__(self, max_size: int, max_memory: int, ttl: float, previous_ttl: float):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.previous_ttl = previous_ttl
+        self._entries: "OrderedDict[Hashable, Union[OccurrenceSet, PreviousScores]]" = OrderedDict()
+        self._memory: Dict[Hashable, int] = {}
+
+    @classmethod
+    def from_config(cls, config) -> "OccurrenceSetCache":
+        return cls(
+            int(config["cache_size"]),
+            int(config["cache_memory"]) * MB,
+            float(config["cache_ttl"]),
+            float(config["previous_ttl"]),
+        )
+
+    @property
+    def memory(self) -> int:
+        """Estimated memory of the entries"""
+        return sum(self._memory.values())
+
+    def _remove_expired(self) -> None:
+        now = time()
+        for key in [key for key, entry in self._entries.items() if now - entry.created > self.ttl + self.previous_ttl]:
+            del self._entries[key]
+            del self._memory[key]
+
+    def get(self, key: Hashable) -> Optional[OccurrenceSet]:
+        """Return the OccurrenceSet if it has not expired"""
+        self._remove_expired()
+        entry = self._entries.get(key)
+        if not isinstance(entry, OccurrenceSet):
+            return None
+        if time() - entry.created > self.ttl:
+            self._entries[key] = entry.get_previous_scores()
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_previous(self, key: Hashable) -> Optional[Union[OccurrenceSet, PreviousScores]]:
+        """Return the OccurrenceSet or the PreviousScores of the expired one, to copy its scores into the next one"""
+        self._remove_expired()
+        return self._entries.get(key)
+
+    def put(self, key: Hashable, occurrence_set: OccurrenceSet, memory: int) -> None:
+        """Add the OccurrenceSet, memory is its estimated memory.
+
+        The last OccurrenceSet is kept even if it is larger than max_memory.
+        """
+        if self.max_size <= 0:
+            return
+        self._remove_expired()
+        self._entries[key] = occurrence_set
+        self._entries.move_to_end(key)
+        self._memory[key] = memory
+        while len(self._entries) > self.max_size or (len(self._entries) > 1 and self.memory > self.max_memory):
+            key, _ = self._entries.popitem(last=False)
+            del self._memory[key]
+
+    def update_decisions(self, relations: List[dict]) -> None:
+        for entry in self._entries.values():
+            if isinstance(entry, OccurrenceSet):
+                entry.update_decisions(relations)
@@ -0,0 +1,78 @@
+"""
+Cooperative CPU-bound work on the event loop.
+
+run_in_slices splits the work in slices of about slice_budget seconds, and yields to
+the event loop between the slices: the other requests wait at most one slice.
+
+EventLoopLagMonitor measures how late the event loop wakes up a sleeping task,
+which is how long the other requests wait.
+"""
+import asyncio
+from collections import deque
+from typing import Callable, Dict, Optional, Sequence
+
+from . import utils
+
+
+__all__ = ['DeadlineExceeded', 'run_in_slices', 'EventLoopLagMonitor']
+
+
+class DeadlineExceeded(Exception):
+    """The work is not finished at the deadline"""
+
+
+async def run_in_slices(function: Callable[[Sequence], None], items: Sequence, slice_budget: float, deadline: float) -> None:
+    """Call function on consecutive slices of items, yield to the event loop between the slices.
+
+    The slice size is adjusted so each call takes about slice_budget seconds.
+    Raise DeadlineExceeded if the items are not all processed at deadline (see loop.time()).
+    """
+    loop = asyncio.get_event_loop()
+    slice_size = 1
+    position = 0
+    while position < len(items):
+        if loop.time() > deadline:
+            raise DeadlineExceeded()
+        with utils.measure_time() as now:
+            function(items[position:position + slice_size])
+        position += slice_size
+        elapsed = now()
+        # at most double the slice size at each step: the first items may be faster than the next ones
+        slice_size = max(1, min(slice_size * 2, int(slice_size * slice_budget / max(elapsed, 1e-6))))
+        await asyncio.sleep(0)
+
+
+class EventLoopLagMonitor:
+
+    def __init__(self, interval: float, window: int):
+        """Measure the lag every interval seconds, keep the window last measures"""
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def gauges(self) -> Dict[str, float]:
+        """Lags in milliseconds"""
+        if not self.lags:
+            return {}
+        return {
+            "lag": round(self.lags[-1] * 1000, 3),
+            "mean_lag": round(sum(self.lags) / len(self.lags) * 1000, 3),
+            "max_lag": round(max(self.lags) * 1000, 3),
+        }
@@ -55,6 +55,33 @@ def parse_args(app_name = ""):
     group.add_argument('--profile', type=str, dest='profile_filename',
                        help='Run cProfile in developpment mode and record the a .prof file',
                        default=None)
+    subparsers = parser.add_subparsers(dest='command', metavar='command',
+                                       help='Without command: run the server')
+    snapshot_parser = subparsers.add_parser('snapshot', help='Save the upstream data in a local directory')
+    snapshot_parser.add_argument('directory', type=str,
+                                 help='Snapshot directory, see [datasource] snapshot_directory in the configuration')
+    snapshot_parser.add_argument('--institutionKey', type=str, dest='institution_keys', action='append',
+                                 help='Save only the datasets of this institution (can be repeated)',
+                                 default=None)
+    snapshot_parser.add_argument('--concurrency', type=int, dest='concurrency',
+                                 help='Number of concurrent upstream requests',
+                                 default=4)
+    snapshot_parser.add_argument('--resume', action='store_true', dest='resume',
+                                 help='Resume an interrupted snapshot: keep the files already fetched by this run')
+    score_parser = subparsers.add_parser('score', help='Score the relations of all the datasets into a directory')
+    score_parser.add_argument('directory', type=str,
+                              help='Output directory: one file per dataset')
+    score_parser.add_argument('--institutionKey', type=str, dest='institution_keys', action='append',
+                              help='Score only the datasets of this institution (can be repeated)',
+                              default=None)
+    score_parser.add_argument('--processes', type=int, dest='processes',
+                              help='Number of scoring processes',
+                              default=multiprocessing.cpu_count())
+    score_parser.add_argument('--format', type=str, dest='output_format', choices=('npz', 'parquet'),
+                              help='Output format, parquet requires pyarrow',
+                              default='npz')
+    score_parser.add_argument('--resume', action='store_true', dest='resume',
+                              help='Resume an interrupted run: skip the datasets already scored by this run')
     return parser.parse_args()
 
 
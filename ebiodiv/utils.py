@@ -1,11 +1,41 @@
 from timeit import default_timer
 from contextlib import contextmanager
+from pathlib import Path
 
 
-__all__ = ['measure_time']
+__all__ = ['measure_time', 'RunManifest']
 
 
 @contextmanager
 def measure_time():
     start = default_timer()
     yield lambda: default_timer() - start
+
+
+class RunManifest:
+    """Names of the files written by a command run (one per line), to resume an interrupted run.
+
+    Without resume, the manifest is emptied: the run writes all the files again.
+    """
+
+    def __init__(self, path: Path, resume: bool):
+        self.done = set(path.read_text().split()) if resume and path.exists() else set()
+        self._file = open(path, "a" if resume else "w")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.done
+
+    def add(self, name: str) -> None:
+        """The file name is written"""
+        self._file.write(name + "\n")
+        self._file.flush()
+        self.done.add(name)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "RunManifest":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -47,4 +47,8 @@ setup(
     zip_safe=False,
     python_requires=">=3.7",
     install_requires=requirements,
+    extras_require={
+        # binary encodings of /api/v2/occurrences?scores=true
+        'binary': ['msgpack==1.0.4', 'pyarrow==8.0.0'],
+    },
 )
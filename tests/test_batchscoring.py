@@ -0,0 +1,46 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import numpy as np
+import orjson
+
+from ebiodiv import batchscoring, datasource
+
+
+class FakeUpstream(datasource.DataSource):
+
+    def __init__(self):
+        self.requests = []
+
+    def _get_content(self, endpoint):
+        if endpoint == "datasets":
+            return [{"institutionKey": 42, "datasetKey": "a"}]
+        return {
+            "occurrences": {
+                "1": {"catalogNumber": "A-1", "recordedBy": "Smith"},
+                "2": {"catalogNumber": "A-1", "recordedBy": "Smith"},
+            },
+            "occurrenceRelations": [{"occurrenceKey1": 1, "occurrenceKey2": 2, "decision": True}],
+        }
+
+    @asynccontextmanager
+    async def request(self, method, endpoint, params=None, json=None):
+        self.requests.append(endpoint)
+        yield datasource.SnapshotResponse(200, orjson.dumps(self._get_content(endpoint)))
+
+
+def test_each_run_scores_again_unless_resumed(tmp_path):
+    summary = asyncio.run(batchscoring.score_datasets(FakeUpstream(), tmp_path, None, 1, "npz"))
+    assert summary["scored"] == 1
+    with np.load(tmp_path / "a.npz") as columns:
+        assert columns["decision"].tolist() == [1]
+
+    # a new run into the same directory
+    summary = asyncio.run(batchscoring.score_datasets(FakeUpstream(), tmp_path, None, 1, "npz"))
+    assert (summary["scored"], summary["skipped"]) == (1, 0)
+
+    # resume: the dataset scored by the previous run is skipped
+    upstream = FakeUpstream()
+    summary = asyncio.run(batchscoring.score_datasets(upstream, tmp_path, None, 1, "npz", resume=True))
+    assert (summary["scored"], summary["skipped"]) == (0, 1)
+    assert upstream.requests == ["datasets"]
@@ -0,0 +1,77 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import orjson
+
+from ebiodiv import datasource
+
+
+def _write_dataset(directory, dataset_key, occ_keys):
+    datasource._write_gzip(directory / "occurrences" / (dataset_key + ".json.gz"), orjson.dumps({
+        "occurrences": {str(occ_key): {"catalogNumber": str(occ_key)} for occ_key in occ_keys},
+        "occurrenceRelations": [{"occurrenceKey1": occ_keys[0], "occurrenceKey2": occ_keys[1], "decision": None}],
+        "subjectOccurrenceKeys": [occ_keys[0]],
+    }))
+
+
+def test_snapshot_merges_the_selected_datasets(tmp_path):
+    (tmp_path / "occurrences").mkdir()
+    _write_dataset(tmp_path, "a", [1, 2])
+    _write_dataset(tmp_path, "b", [3, 4])
+    (tmp_path / "index.json").write_bytes(orjson.dumps({"institutions": {"42": ["a", "b"]}}))
+
+    async def get(params):
+        source = datasource.SnapshotDataSource(str(tmp_path), 8)
+        await source.start()
+        async with source.request("get", "occurrences", params=params) as response:
+            return response.status, orjson.loads(await response.read())
+
+    # the frontend joins the dataset keys with "+", decoded as a space
+    status, data = asyncio.run(get({"institutionKey": "42", "datasetKey": "a b"}))
+    assert status == 200
+    assert set(data["occurrences"]) == {"1", "2", "3", "4"}
+    assert data["subjectOccurrenceKeys"] == [1, 3]
+
+    status, data = asyncio.run(get({"institutionKey": "42", "occurrenceKeys": "4"}))
+    assert status == 200
+    assert set(data["occurrences"]) == {"3", "4"}
+    assert data["subjectOccurrenceKeys"] == [3]
+
+
+class FakeUpstream(datasource.DataSource):
+
+    def __init__(self, version):
+        self.version = version
+        self.requests = []
+
+    def _get_content(self, endpoint, params):
+        if endpoint == "datasets":
+            return [{"institutionKey": 42, "datasetKey": "a"}]
+        if endpoint == "occurrences":
+            return {"occurrences": {}, "occurrenceRelations": [], "version": self.version}
+        return []
+
+    @asynccontextmanager
+    async def request(self, method, endpoint, params=None, json=None):
+        self.requests.append(endpoint)
+        yield datasource.SnapshotResponse(200, orjson.dumps(self._get_content(endpoint, params)))
+
+
+def _read_dataset(directory):
+    return orjson.loads(datasource._read_gzip(directory / "occurrences" / "a.json.gz"))
+
+
+def test_snapshot_is_fetched_again_unless_resumed(tmp_path):
+    asyncio.run(datasource.take_snapshot(FakeUpstream(1), tmp_path, None, 2))
+    assert _read_dataset(tmp_path)["version"] == 1
+
+    # resume: the files fetched by the previous run are kept
+    upstream = FakeUpstream(2)
+    asyncio.run(datasource.take_snapshot(upstream, tmp_path, None, 2, resume=True))
+    assert upstream.requests == []
+    assert _read_dataset(tmp_path)["version"] == 1
+
+    # new run: all the files are fetched again
+    asyncio.run(datasource.take_snapshot(FakeUpstream(2), tmp_path, None, 2))
+    assert _read_dataset(tmp_path)["version"] == 2
+    assert orjson.loads((tmp_path / "index.json").read_bytes()) == {"institutions": {"42": ["a"]}}
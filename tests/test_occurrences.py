@@ -0,0 +1,97 @@
+import os
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import orjson
+import pytest
+
+# ebiodiv.server parses the command line on import, ebiodiv.app serves the "static" directory
+sys.argv = sys.argv[:1]
+os.chdir(Path(__file__).parent.parent)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from ebiodiv import app as app_module  # noqa: E402
+from ebiodiv import datasource  # noqa: E402
+
+
+OCCURRENCES = {
+    "occurrences": {
+        "1": {"catalogNumber": "A-1", "recordedBy": "Smith"},
+        "2": {"catalogNumber": "A-1", "recordedBy": "Smith J."},
+        "3": {"catalogNumber": "B-2", "recordedBy": "Doe"},
+        "4": {"catalogNumber": "B-2", "recordedBy": "Doe"},
+    },
+    "occurrenceRelations": [
+        {"occurrenceKey1": 1, "occurrenceKey2": 2, "decision": None},
+        {"occurrenceKey1": 3, "occurrenceKey2": 4, "decision": None},
+    ],
+    "subjectOccurrenceKeys": [1, 3],
+}
+
+
+class FakeResponse:
+
+    status = 200
+    headers = {"Content-Type": "application/json"}
+
+    async def read(self) -> bytes:
+        return orjson.dumps(OCCURRENCES)
+
+
+class FakeDataSource(datasource.DataSource):
+
+    @asynccontextmanager
+    async def request(self, method, endpoint, params=None, json=None):
+        yield FakeResponse()
+
+
+@pytest.fixture(params=[False, True], ids=["executor", "cooperative"])
+def client(request, monkeypatch):
+    monkeypatch.setattr(app_module, "COOPERATIVE_SCORING", request.param)
+    monkeypatch.setattr(app_module, "DATA_SOURCE", FakeDataSource())
+    monkeypatch.setattr(app_module, "OCCURRENCE_SETS", app_module.OccurrenceSetCache(4, 512 * 1024 * 1024, 600, 600))
+    return TestClient(app_module.app)
+
+
+def test_scored_occurrences_keep_subject_occurrence_keys(client):
+    response = client.get("/api/v2/occurrences", params={"scores": "true", "institutionKey": "42"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["subjectOccurrenceKeys"] == [1, 3]
+    assert all("scores" in relation for relation in data["occurrenceRelations"])
+
+
+def test_window_filters_subject_occurrence_keys(client):
+    response = client.get("/api/v2/occurrences", params={"scores": "true", "institutionKey": "42", "offset": 1, "limit": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert set(data["occurrences"]) == {"3", "4"}
+    assert data["subjectOccurrenceKeys"] == [3]
+
+
+class FakeDecisionQueue:
+
+    def __init__(self):
+        self.pending = {}
+
+    def put(self, relations):
+        for relation in relations:
+            self.pending[(relation["occurrenceKey1"], relation["occurrenceKey2"])] = relation
+
+
+def test_occurrences_include_queued_decisions(client, monkeypatch):
+    monkeypatch.setattr(app_module, "DECISION_QUEUE", FakeDecisionQueue())
+    response = client.post(
+        "/api/v2/occurrenceRelations",
+        json={"occurrenceRelations": [{"occurrenceKey1": 1, "occurrenceKey2": 2, "decision": True}]},
+    )
+    assert response.status_code == 202
+    # the full list is fetched again from the upstream, which doesn't have the decision yet
+    response = client.get("/api/v2/occurrences", params={"scores": "true", "institutionKey": "42"})
+    decisions = {
+        (relation["occurrenceKey1"], relation["occurrenceKey2"]): relation["decision"]
+        for relation in response.json()["occurrenceRelations"]
+    }
+    assert decisions == {(1, 2): True, (3, 4): None}